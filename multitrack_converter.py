@@ -4,6 +4,7 @@ con diferentes instrumentos usando pretty_midi.
 """
 
 import pretty_midi
+import numpy as np
 import os
 
 def convert_to_multitrack(input_midi_path, output_path, instrument_programs=[0, 24, 40]):
@@ -32,21 +33,24 @@ def convert_to_multitrack(input_midi_path, output_path, instrument_programs=[0,
     # Crear nuevo archivo MIDI
     new_midi = pretty_midi.PrettyMIDI(resolution=midi_data.resolution, initial_tempo=midi_data.estimate_tempo())
     
+    # Extraer una sola vez las notas del archivo original como arrays
+    src_notes = midi_data.instruments[0].notes
+    velocities = [n.velocity for n in src_notes]
+    pitches = np.fromiter((n.pitch for n in src_notes), dtype=np.int16, count=len(src_notes))
+    starts = [n.start for n in src_notes]
+    ends = [n.end for n in src_notes]
+    
     # Para cada instrumento, crear un nuevo instrumento y copiar las notas
     for i, program in enumerate(instrument_programs):
         # Crear nuevo instrumento
         instrument = pretty_midi.Instrument(program=program, name=f"Instrument_{i}")
         
-        # Obtener todas las notas del archivo original
-        for old_note in midi_data.instruments[0].notes:
-            # Crear nueva nota con un offset de octava para cada instrumento
-            new_note = pretty_midi.Note(
-                velocity=old_note.velocity,
-                pitch=old_note.pitch + (i * 12),  # Transponer una octava arriba para cada instrumento
-                start=old_note.start,
-                end=old_note.end
-            )
-            instrument.notes.append(new_note)
+        # Transponer una octava arriba para cada instrumento
+        new_pitches = (pitches + i * 12).tolist()
+        instrument.notes = [
+            pretty_midi.Note(velocity=v, pitch=p, start=s, end=e)
+            for v, p, s, e in zip(velocities, new_pitches, starts, ends)
+        ]
         
         # Agregar el instrumento al nuevo archivo MIDI
         new_midi.instruments.append(instrument)
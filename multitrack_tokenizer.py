@@ -4,58 +4,65 @@ para soportar múltiples instrumentos y polifonía.
 """
 
 import mido
+import numpy as np
 from multitrack_vocabulary import *
-from dataclasses import dataclass
-from typing import List, Dict, Optional
-from torch import LongTensor
-
-@dataclass
-class MidiEvent:
-    """Clase para representar un evento MIDI con toda la información necesaria"""
-    type: str  # 'note_on', 'note_off', 'time_shift', 'set_velocity', 'set_instrument'
-    note: Optional[int] = None
-    velocity: Optional[int] = None
-    instrument: Optional[int] = None
-    time: Optional[int] = None
-    program: Optional[int] = None
-
-def midi_parser(fname=None, mid=None):
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import List, Dict
+from torch import from_numpy
+
+try:
+    import symusic
+except ImportError:
+    symusic = None
+
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        return lambda f: f
+
+# Códigos de tipo de evento (los eventos se guardan como arrays paralelos, sin un objeto por evento).
+# El valor numérico solo define el desempate en _symusic_events (instrumento -> note_off -> note_on);
+# _mido_events conserva el orden de los mensajes del archivo en eventos simultáneos
+TYPE_INSTR = 0
+TYPE_NOTE_OFF = 1
+TYPE_NOTE_ON = 2
+
+# Tablas de índices como arrays para el bucle compilado
+_NOTE_ON_TABLE = np.asarray(NOTE_ON_IDX, dtype=np.int64)
+_NOTE_OFF_TABLE = np.asarray(NOTE_OFF_IDX, dtype=np.int64)
+_VEL_TABLE = np.asarray(VEL_IDX, dtype=np.int64)
+_INSTR_TABLE = np.asarray(INSTR_IDX, dtype=np.int64)
+_CHANNEL_TABLE = np.asarray(CHANNEL_IDX, dtype=np.int64)
+_TIME_SHIFT_TABLE = np.asarray(TIME_SHIFT_IDX, dtype=np.int64)
+_TIME_SHIFT_MS_TABLE = np.asarray(TIME_SHIFT_MS, dtype=np.int64)
+
+# time_cutter compilado para usarlo dentro de _emit_tokens
+_time_cutter = njit(cache=True)(time_cutter)
+
+def _mido_events(fname=None, mid=None):
     """
-    Traduce un archivo MIDI multitrack a la representación de vocabulario extendida.
-    
-    Args:
-        fname (str): ruta al archivo MIDI a cargar O
-        mid (mido.MidiFile): archivo MIDI ya cargado
-        
-    Returns:
-        index_list (torch.Tensor): lista de índices en el vocabulario
-        event_list (list): lista de eventos en el vocabulario
-        tempo (int): tempo del archivo MIDI
+    Lee un archivo MIDI con mido y devuelve sus eventos con tiempos absolutos ordenados por tiempo,
+    como arrays paralelos (times, types, notes, vels, insts), junto con el tempo del archivo.
+    En los eventos de instrumento, insts guarda el programa.
     """
-    if not ((fname is None) ^ (mid is None)):
-        raise ValueError("Input one of fname or mid, not both or neither")
-
     if fname is not None:
         try:
             mid = mido.MidiFile(fname)
         except mido.midifiles.meta.KeySignatureError as e:
             raise ValueError(e)
 
-    # Estructuras de datos para el procesamiento
-    event_list = []
-    index_list = []
     tempo = 0
-    
-    # Diccionario para mantener el estado de las notas activas por instrumento
-    active_notes: Dict[int, Dict[int, int]] = {}  # instrument -> {note -> velocity}
-    # Diccionario para mantener el programa (instrumento) asignado a cada canal
-    channel_programs: Dict[int, int] = {}
+    # Programa (instrumento) asignado a cada canal, indexado por canal; 0 por defecto
+    channel_programs: List[int] = [0] * 16
+    # Último program_change de cada canal; -1 si aún no hubo ninguno
+    declared_programs: List[int] = [-1] * 16
     
     # Acumular todos los eventos con sus tiempos absolutos
-    absolute_events: List[MidiEvent] = []
+    times, types, notes, vels, insts = [], [], [], [], []
     current_time = 0
     
-    # Primera pasada: recolectar todos los eventos con tiempos absolutos
     for track in mid.tracks:
         for msg in track:
             current_time += msg.time
@@ -67,71 +74,221 @@ def midi_parser(fname=None, mid=None):
                 
             if msg.type in ['note_on', 'note_off']:
                 # Normalizar note_on con velocidad 0 a note_off
-                if msg.type == 'note_on' and msg.velocity == 0:
-                    msg_type = 'note_off'
+                if msg.type == 'note_on' and msg.velocity > 0:
+                    types.append(TYPE_NOTE_ON)
                 else:
-                    msg_type = msg.type
-                    
+                    types.append(TYPE_NOTE_OFF)
+                times.append(current_time)
+                notes.append(msg.note)
+                vels.append(msg.velocity)
                 # Obtener el programa/instrumento para este canal
-                instrument = channel_programs.get(msg.channel, 0)
-                
-                absolute_events.append(MidiEvent(
-                    type=msg_type,
-                    note=msg.note,
-                    velocity=msg.velocity,
-                    instrument=instrument,
-                    time=current_time
-                ))
+                insts.append(channel_programs[msg.channel])
                 
             elif msg.type == 'program_change':
+                # Ignorar cambios de programa que no cambian nada en el canal
+                if declared_programs[msg.channel] == msg.program:
+                    continue
+                declared_programs[msg.channel] = msg.program
                 channel_programs[msg.channel] = msg.program
-                absolute_events.append(MidiEvent(
-                    type='set_instrument',
-                    instrument=msg.channel,
-                    program=msg.program,
-                    time=current_time
-                ))
+                times.append(current_time)
+                types.append(TYPE_INSTR)
+                notes.append(0)
+                vels.append(0)
+                insts.append(msg.program)
     
-    # Ordenar eventos por tiempo
-    absolute_events.sort(key=lambda x: x.time)
+    times, types, notes, vels, insts = (np.asarray(a, dtype=np.int64) for a in (times, types, notes, vels, insts))
+
+    # Ordenar eventos por tiempo, conservando el orden de los mensajes simultáneos
+    order = np.argsort(times, kind="stable")
     
-    # Inicializar con token de inicio
-    event_list.append('<start>')
-    index_list.append(start_token)
+    return (times[order], types[order], notes[order], vels[order], insts[order]), tempo
+
+def _symusic_events(fname):
+    """
+    Lee un archivo MIDI con symusic (sin recorrer mensajes en Python) y devuelve sus eventos con tiempos
+    absolutos en ticks ordenados por tiempo, en el mismo formato que _mido_events, junto con el tempo del archivo.
+
+    symusic empareja él mismo note_on y note_off: descarta los note_off huérfanos y también los note_on que
+    nunca se cierran. Además emite un set_instrument por track en t=0 con el programa del track (ignorando
+    program_change a mitad de track) y usa tiempos por track, así que su salida puede diferir de la de mido.
+    """
+    score = symusic.Score(fname, ttype="tick")
+    tempo = score.tempos[0].mspq if len(score.tempos) > 0 else 0
+
+    times, types, notes, vels, insts = [], [], [], [], []
+    for track in score.tracks:
+        arrays = track.notes.numpy()
+        n = len(arrays["time"])
+        if n == 0:
+            continue
+        # Cambio de instrumento al inicio del track
+        times.append(np.zeros(1, dtype=np.int64))
+        types.append(np.full(1, TYPE_INSTR, dtype=np.int64))
+        notes.append(np.zeros(1, dtype=np.int64))
+        vels.append(np.zeros(1, dtype=np.int64))
+        insts.append(np.full(1, track.program, dtype=np.int64))
+        # note_on y note_off de cada nota
+        times.append(np.concatenate([arrays["time"], arrays["time"] + arrays["duration"]]))
+        types.append(np.concatenate([np.full(n, TYPE_NOTE_ON), np.full(n, TYPE_NOTE_OFF)]))
+        notes.append(np.tile(arrays["pitch"], 2))
+        vels.append(np.tile(arrays["velocity"], 2))
+        insts.append(np.full(2 * n, track.program, dtype=np.int64))
+
+    if not times:
+        return tuple(np.empty(0, dtype=np.int64) for _ in range(5)), tempo
+
+    times, types, notes, vels, insts = (np.concatenate(a).astype(np.int64) for a in (times, types, notes, vels, insts))
+    # Ordenar eventos por tiempo y, en eventos simultáneos, por tipo (instrumento -> note_off -> note_on)
+    order = np.lexsort((types, times))
     
+    return (times[order], types[order], notes[order], vels[order], insts[order]), tempo
+
+@njit(cache=True, boundscheck=False)
+def _emit_tokens(times, types, notes, vels, insts, note_on_table, note_off_table, vel_table, instr_table,
+                 channel_table, time_shift_table, time_shift_ms, lth, bin_step, start, end):
+    """
+    Emite los índices del vocabulario para los eventos ordenados en un buffer int16 preasignado.
+    Compilado con numba si está disponible.
+    """
+    n = len(types)
+    # Cota superior: inicio/fin + (time_shift máximo por redondeo, time_shift sobrante, velocidad, canal, nota)
+    # por evento + time_shifts máximos
+    cap = 2 + 5 * n
+    if n > 0:
+        cap += times[n - 1] // lth
+    out = np.empty(cap, dtype=np.int16)
+    max_time_shift = time_shift_table[len(time_shift_table) - 1]
+
+    w = 0
+    out[w] = start
+    w += 1
+    last_vel_bin = -1
+    last_inst = -1
+    last_program = -1
+    # Tiempo ya emitido en time_shifts; cada delta se mide desde aquí para que el error de
+    # redondeo no se acumule a lo largo del archivo
+    emitted = 0
+    for i in range(n):
+        # Procesar tiempo delta: k time_shifts máximos + un time_shift sobrante (redondeado)
+        if times[i] > emitted:
+            full, leftover = _time_cutter(times[i] - emitted)
+            for _ in range(full):
+                out[w] = max_time_shift
+                w += 1
+            emitted += full * lth
+            if leftover >= 0:
+                out[w] = time_shift_table[leftover]
+                w += 1
+                emitted += time_shift_ms[leftover]
+
+        if types[i] == TYPE_INSTR:
+            # Agregar evento de cambio de instrumento solo si cambia el programa
+            if insts[i] != last_program:
+                out[w] = instr_table[insts[i]]
+                w += 1
+                last_program = insts[i]
+            continue
+
+        if types[i] == TYPE_NOTE_ON:
+            # Agregar evento de velocidad solo si cambia el bin
+            vel_bin = vels[i] // bin_step
+            if vel_bin != last_vel_bin:
+                out[w] = vel_table[vel_bin]
+                w += 1
+                last_vel_bin = vel_bin
+        # Agregar evento de canal solo si cambia el instrumento, y luego el de nota
+        if insts[i] != last_inst:
+            out[w] = channel_table[insts[i]]
+            w += 1
+            last_inst = insts[i]
+        if types[i] == TYPE_NOTE_ON:
+            out[w] = note_on_table[notes[i]]
+        else:
+            out[w] = note_off_table[notes[i]]
+        w += 1
+
+    out[w] = end
+    w += 1
+    return out[:w]
+
+def midi_parser(fname=None, mid=None, backend="mido", emit_events=True):
+    """
+    Traduce un archivo MIDI multitrack a la representación de vocabulario extendida.
+    
+    Args:
+        fname (str): ruta al archivo MIDI a cargar O
+        mid (mido.MidiFile): archivo MIDI ya cargado
+        backend (str, optional): "mido" o "symusic"; symusic es más rápido pero solo admite fname y
+                                 empareja las notas por su cuenta, descartando note_on sin cerrar y
+                                 note_off huérfanos (ver _symusic_events)
+        emit_events (bool, optional): si es False no se construye event_list y se devuelve None en su lugar
+        
+    Returns:
+        index_list (torch.Tensor): lista de índices en el vocabulario, como int16; convertir con .long()
+                                   antes de pasarla a un nn.Embedding
+        event_list (list or None): lista de eventos en el vocabulario
+        tempo (int): tempo del archivo MIDI
+    """
+    if not ((fname is None) ^ (mid is None)):
+        raise ValueError("Input one of fname or mid, not both or neither")
+    if backend not in ("symusic", "mido"):
+        raise ValueError(f"backend must be 'symusic' or 'mido', not {backend}")
+    if backend == "symusic":
+        if symusic is None:
+            raise ImportError("backend='symusic' requires the symusic package to be installed")
+        if mid is not None:
+            raise ValueError("backend='symusic' only accepts fname, not a loaded mido.MidiFile")
+
+    # Primera pasada: recolectar todos los eventos con tiempos absolutos
+    if backend == "symusic":
+        (times, types, notes, vels, insts), tempo = _symusic_events(fname)
+    else:
+        (times, types, notes, vels, insts), tempo = _mido_events(fname, mid)
+
+    # Validar instrumentos antes de indexar las tablas sin comprobación de límites
+    note_insts = insts[types != TYPE_INSTR]
+    if note_insts.size > 0 and note_insts.max() >= max_instruments:
+        raise ValueError(f"instrument must be between 0 and {max_instruments-1}, not {note_insts.max()}")
+
     # Segunda pasada: convertir eventos a tokens
-    last_time = 0
-    for event in absolute_events:
-        # Procesar tiempo delta
-        if event.time > last_time:
-            delta_time = event.time - last_time
-            time_to_events(delta_time, event_list, index_list)
-            last_time = event.time
-            
-        if event.type == 'set_instrument':
-            # Agregar evento de cambio de instrumento
-            event_str = f"set_instrument_{event.program}"
-            event_list.append(event_str)
-            index_list.append(vocab.index(event_str))
-            
-        elif event.type in ['note_on', 'note_off']:
-            if event.type == 'note_on':
-                # Agregar evento de velocidad si es note_on
-                vel_bin = velocity_to_bin(event.velocity)
-                vel_str = f"set_velocity_{vel_bin}"
-                event_list.append(vel_str)
-                index_list.append(vocab.index(vel_str))
-                
-            # Agregar evento de nota
-            note_str = f"{event.type}_{event.note}_{event.instrument}"
-            event_list.append(note_str)
-            index_list.append(vocab.index(note_str))
+    index_list = _emit_tokens(times, types, notes, vels, insts, _NOTE_ON_TABLE, _NOTE_OFF_TABLE, _VEL_TABLE,
+                              _INSTR_TABLE, _CHANNEL_TABLE, _TIME_SHIFT_TABLE, _TIME_SHIFT_MS_TABLE, LTH, BIN_STEP,
+                              start_token, end_token)
     
-    # Agregar token de fin
-    event_list.append('<end>')
-    index_list.append(end_token)
+    event_list = indices_to_events(index_list.tolist()) if emit_events else None
     
-    return LongTensor(index_list), event_list, tempo
+    return from_numpy(index_list), event_list, tempo
+
+
+def _try_midi_parser(fname, emit_events=True):
+    """
+    midi_parser para tokenize_files: devuelve None si el archivo no se puede traducir,
+    igual que el bucle de preprocessing.py, para no perder el resto del lote
+    """
+    try:
+        return midi_parser(fname=fname, emit_events=emit_events)
+    except (OSError, ValueError, EOFError) as ex:
+        print(f"{type(ex).__name__} was raised on {fname}: {ex}")
+        return None
+
+def tokenize_files(paths, workers=None, chunksize=16, emit_events=True):
+    """
+    Traduce varios archivos MIDI con midi_parser en paralelo, un proceso por núcleo.
+    Los archivos que lanzan OSError, ValueError o EOFError no detienen el lote: se informa
+    del error y su resultado es None.
+    
+    Args:
+        paths (list): rutas a los archivos MIDI
+        workers (int, optional): número de procesos; por defecto os.cpu_count()
+        chunksize (int, optional): archivos enviados a cada proceso por tanda
+        emit_events (bool, optional): si es False, no se construyen ni se envían de vuelta las listas de eventos
+        
+    Returns:
+        list: salida de midi_parser (index_list, event_list, tempo) para cada archivo, en el mismo orden,
+              o None para los archivos que no se pudieron traducir
+    """
+    with ProcessPoolExecutor(workers) as executor:
+        return list(executor.map(partial(_try_midi_parser, emit_events=emit_events), paths, chunksize=chunksize))
 
 def list_parser(index_list=None, event_list=None, fname="output", tempo=512820):
     """
@@ -156,7 +313,12 @@ def list_parser(index_list=None, event_list=None, fname="output", tempo=512820):
         except AttributeError:
             if not all([isinstance(i, int) for i in index_list]):
                 raise ValueError("All indices in index_list must be int type")
-        event_list = indices_to_events(index_list)
+    else:
+        index_list = events_to_indices(event_list)
+
+    # Clase y parámetro de cada token, sin pasar por su cadena
+    index_list = np.asarray(index_list, dtype=np.int64)
+    tokens = zip(TOKEN_CLASS[index_list].tolist(), TOKEN_PARAM[index_list].tolist())
 
     # Configurar archivo MIDI
     mid = mido.MidiFile()
@@ -167,71 +329,60 @@ def list_parser(index_list=None, event_list=None, fname="output", tempo=512820):
     meta_track.append(mido.MetaMessage("set_tempo", tempo=tempo, time=0))
     mid.tracks.append(meta_track)
     
-    # Diccionario para mantener tracks por instrumento
-    instrument_tracks: Dict[int, mido.MidiTrack] = {}
-    current_instrument = 0
+    # Programa inicial de cada track, en orden de creación
+    track_programs: Dict[int, int] = {}
+    current_channel = 0
     current_velocity = 64
     delta_time = 0
     
-    # Procesar eventos
-    for event in event_list:
-        if event in ['<pad>', '<start>', '<end>']:
-            continue
-            
-        if event.startswith('time_shift_'):
+    # Mensajes de nota como arrays paralelos
+    msg_insts, msg_is_on, msg_notes, msg_vels, msg_deltas = [], [], [], [], []
+    
+    # Primera pasada: clasificar tokens y acumular los mensajes de nota
+    for token_type, value in tokens:
+        if token_type == CLASS_TS:
             # Acumular tiempo delta
-            time_value = int(event.split('_')[-1])
-            delta_time += time_value * DIV
-            continue
+            delta_time += TIME_SHIFT_MS[value]
             
-        if event.startswith('set_velocity_'):
+        elif token_type == CLASS_VEL:
             # Actualizar velocidad actual
-            vel_bin = int(event.split('_')[-1])
-            current_velocity = bin_to_velocity(vel_bin)
-            continue
+            current_velocity = bin_to_velocity(value)
             
-        if event.startswith('set_instrument_'):
-            # Cambiar instrumento actual
-            program = int(event.split('_')[-1])
-            current_instrument = program
-            if current_instrument not in instrument_tracks:
-                track = mido.MidiTrack()
-                track.append(mido.Message('program_change', 
-                                        program=program,
-                                        channel=current_instrument % 16,
-                                        time=0))
-                instrument_tracks[current_instrument] = track
-                mid.tracks.append(track)
-            continue
+        elif token_type == CLASS_CHANNEL:
+            # Cambiar canal de las notas siguientes
+            current_channel = value
+            
+        elif token_type == CLASS_INSTR:
+            # Crear track para el programa si no existe
+            if value not in track_programs:
+                track_programs[value] = value
             
         # Procesar eventos de nota
-        if event.startswith(('note_on_', 'note_off_')):
-            parts = event.split('_')
-            note_type = parts[0] + '_' + parts[1]
-            note = int(parts[2])
-            instrument = int(parts[3])
+        elif token_type != CLASS_SPECIAL:
+            is_on = token_type == CLASS_NOTE_ON
             
             # Asegurarse de que existe el track para este instrumento
-            if instrument not in instrument_tracks:
-                track = mido.MidiTrack()
-                track.append(mido.Message('program_change',
-                                        program=0,  # default program
-                                        channel=instrument % 16,
-                                        time=0))
-                instrument_tracks[instrument] = track
-                mid.tracks.append(track)
+            if current_channel not in track_programs:
+                track_programs[current_channel] = 0  # default program
             
-            # Crear mensaje MIDI
-            msg = mido.Message(
-                'note_on' if note_type == 'note_on' else 'note_off',
-                note=note,
-                velocity=current_velocity if note_type == 'note_on' else 0,
-                channel=instrument % 16,
-                time=delta_time
-            )
-            
-            # Agregar mensaje al track correspondiente
-            instrument_tracks[instrument].append(msg)
+            msg_insts.append(current_channel)
+            msg_is_on.append(is_on)
+            msg_notes.append(value)
+            msg_vels.append(current_velocity if is_on else 0)
+            msg_deltas.append(delta_time)
             delta_time = 0  # Resetear delta time después de usar
     
-    return mid 
\ No newline at end of file
+    # Segunda pasada: construir cada track de una vez con sus mensajes
+    msg_insts = np.asarray(msg_insts, dtype=np.int64)
+    for instrument, program in track_programs.items():
+        channel = instrument % 16
+        track = mido.MidiTrack()
+        track.append(mido.Message('program_change', program=program, channel=channel, time=0))
+        track.extend([
+            mido.Message('note_on' if msg_is_on[i] else 'note_off', note=msg_notes[i], velocity=msg_vels[i],
+                         channel=channel, time=msg_deltas[i])
+            for i in np.flatnonzero(msg_insts == instrument).tolist()
+        ])
+        mid.tracks.append(track)
+    
+    return mid
\ No newline at end of file
@@ -3,12 +3,20 @@ Vocabulario extendido para soportar eventos MIDI multitrack basado en Oore et al
 pero adaptado para manejar múltiples instrumentos y polifonía.
 """
 
+import numpy as np
+from typing import Dict
+
 """MANIFEST CONSTANTS"""
 
 # Constantes originales
 note_on_events = 128
 note_off_events = note_on_events
-time_shift_events = 125
+# Rejilla adaptativa de time_shift: pasos finos para tiempos cortos y gruesos para silencios largos
+# Cada segmento empieza justo después del anterior, sin huecos en la rejilla
+short_time_shift_events, short_time_step = 50, 2      # 2 - 100 ms
+medium_time_shift_events, medium_time_step = 40, 12   # 112 - 580 ms
+long_time_shift_events, long_time_step = 35, 40       # 620 - 1980 ms
+time_shift_events = short_time_shift_events + medium_time_shift_events + long_time_shift_events
 velocity_events = 32
 
 # Nuevas constantes para instrumentos
@@ -16,32 +24,77 @@ max_instruments = 16  # Número máximo de canales MIDI
 instrument_events = 128  # Número de programas MIDI estándar
 
 # Constantes de tiempo
-LTH = 1000  # max milliseconds
-DIV = LTH // time_shift_events  # 1 time_shift = DIV milliseconds
+# Duración en ms de cada time_shift_k
+TIME_SHIFT_MS = [short_time_step * (i + 1) for i in range(short_time_shift_events)]
+TIME_SHIFT_MS += [TIME_SHIFT_MS[-1] + medium_time_step * (i + 1) for i in range(medium_time_shift_events)]
+TIME_SHIFT_MS += [TIME_SHIFT_MS[-1] + long_time_step * (i + 1) for i in range(long_time_shift_events)]
+LTH = TIME_SHIFT_MS[-1]  # max milliseconds
+# Umbral inferior de cada time_shift_k (punto medio con el anterior): un tiempo t se redondea a
+# searchsorted(TIME_EDGES, t, side="right") - 1; -1 indica que no hay time_shift.
+# El error de redondeo es como mucho medio paso del segmento (1, 6 o 20 ms)
+TIME_EDGES = (np.asarray(TIME_SHIFT_MS, dtype=np.float64) + np.asarray([0] + TIME_SHIFT_MS[:-1])) / 2
 BIN_STEP = 128 // velocity_events
 
-# Crear vocabulario extendido
-note_on_vocab = [f"note_on_{i}_{inst}" for inst in range(max_instruments) for i in range(note_on_events)]
-note_off_vocab = [f"note_off_{i}_{inst}" for inst in range(max_instruments) for i in range(note_off_events)]
+# Crear vocabulario extendido; el canal de las notas se indica con un token set_channel aparte
+# en lugar de multiplicar los tokens de nota por el número de canales
+note_on_vocab = [f"note_on_{i}" for i in range(note_on_events)]
+note_off_vocab = [f"note_off_{i}" for i in range(note_off_events)]
 time_shift_vocab = [f"time_shift_{i}" for i in range(time_shift_events)]
 velocity_vocab = [f"set_velocity_{i}" for i in range(velocity_events)]
 instrument_vocab = [f"set_instrument_{i}" for i in range(instrument_events)]
+channel_vocab = [f"set_channel_{i}" for i in range(max_instruments)]
 
 # Vocabulario completo
-vocab = ['<pad>'] + note_on_vocab + note_off_vocab + time_shift_vocab + velocity_vocab + instrument_vocab + ['<start>', '<end>']
+vocab = ['<pad>'] + note_on_vocab + note_off_vocab + time_shift_vocab + velocity_vocab + instrument_vocab + \
+        channel_vocab + ['<start>', '<end>']
 vocab_size = len(vocab)
+# midi_parser devuelve los índices como int16
+assert vocab_size < 2 ** 15, f"vocab_size ({vocab_size}) does not fit in int16 indices"
+
+# Inicio de cada bloque de tokens en el vocabulario
+NOTE_ON_START = 1  # después de <pad>
+NOTE_OFF_START = NOTE_ON_START + len(note_on_vocab)
+TS_START = NOTE_OFF_START + len(note_off_vocab)
+VEL_START = TS_START + time_shift_events
+INSTR_START = VEL_START + velocity_events
+CHANNEL_START = INSTR_START + instrument_events
+
+# Mapa token -> índice para búsquedas O(1) en lugar de vocab.index
+TOKEN2IDX: Dict[str, int] = {token: i for i, token in enumerate(vocab)}
+
+# Tablas precalculadas de índices para evitar formatear y buscar strings por evento
+NOTE_ON_IDX = [TOKEN2IDX[f"note_on_{n}"] for n in range(note_on_events)]
+NOTE_OFF_IDX = [TOKEN2IDX[f"note_off_{n}"] for n in range(note_off_events)]
+TIME_SHIFT_IDX = [TOKEN2IDX[f"time_shift_{i}"] for i in range(time_shift_events)]
+MAX_TIME_SHIFT_IDX = TIME_SHIFT_IDX[-1]
+VEL_IDX = [TOKEN2IDX[f"set_velocity_{i}"] for i in range(velocity_events)]
+INSTR_IDX = [TOKEN2IDX[f"set_instrument_{i}"] for i in range(instrument_events)]
+CHANNEL_IDX = [TOKEN2IDX[f"set_channel_{i}"] for i in range(max_instruments)]
+
+# Clase y parámetro (nota, k del time_shift, bin, programa o canal) de cada índice del vocabulario
+CLASS_SPECIAL, CLASS_NOTE_ON, CLASS_NOTE_OFF, CLASS_TS, CLASS_VEL, CLASS_INSTR, CLASS_CHANNEL = range(7)
+TOKEN_CLASS = np.full(vocab_size, CLASS_SPECIAL, dtype=np.uint8)
+TOKEN_PARAM = np.zeros(vocab_size, dtype=np.int16)
+for _cls, _start, _n in ((CLASS_NOTE_ON, NOTE_ON_START, note_on_events),
+                         (CLASS_NOTE_OFF, NOTE_OFF_START, note_off_events),
+                         (CLASS_TS, TS_START, time_shift_events),
+                         (CLASS_VEL, VEL_START, velocity_events),
+                         (CLASS_INSTR, INSTR_START, instrument_events),
+                         (CLASS_CHANNEL, CHANNEL_START, max_instruments)):
+    TOKEN_CLASS[_start:_start + _n] = _cls
+    TOKEN_PARAM[_start:_start + _n] = np.arange(_n)
 
 # Tokens especiales
-pad_token = vocab.index("<pad>")
-start_token = vocab.index("<start>")
-end_token = vocab.index("<end>")
+pad_token = TOKEN2IDX["<pad>"]
+start_token = TOKEN2IDX["<start>"]
+end_token = TOKEN2IDX["<end>"]
 
 """HELPER FUNCTIONS"""
 
 def events_to_indices(event_list, _vocab=None):
     """Convierte lista de eventos a índices en el vocabulario"""
     if _vocab is None:
-        _vocab = vocab
+        return [TOKEN2IDX[event] for event in event_list]
     return [_vocab.index(event) for event in event_list]
 
 def indices_to_events(index_list, _vocab=None):
@@ -68,36 +121,29 @@ def time_to_events(delta_time, event_list=None, index_list=None, _vocab=None):
     """Traduce tiempo delta acumulado entre eventos MIDI al vocabulario"""
     if _vocab is None:
         _vocab = vocab
-    time = time_cutter(delta_time)
-    base_idx = len(note_on_vocab) + len(note_off_vocab)
-    for i in time:
-        idx = base_idx + i
-        if event_list is not None:
-            event_list.append(_vocab[idx])
-        if index_list is not None:
-            index_list.append(idx)
-
-def time_cutter(time, lth=LTH, div=DIV):
+    full, leftover_time_shift = time_cutter(delta_time)
+    indices = [MAX_TIME_SHIFT_IDX] * int(full)
+    if leftover_time_shift >= 0:
+        indices.append(TIME_SHIFT_IDX[leftover_time_shift])
+    if event_list is not None:
+        event_list.extend(_vocab[idx] for idx in indices)
+    if index_list is not None:
+        index_list.extend(indices)
+
+def time_cutter(time):
     """
-    Corta el tiempo en segmentos según el vocabulario definido
+    Corta el tiempo en segmentos según el vocabulario definido: k time_shifts máximos
+    y un time_shift sobrante redondeado al más cercano de la rejilla adaptativa.
+    Acepta un entero o un array de tiempos. Para una secuencia de eventos, el tiempo a cortar
+    debe medirse desde el tiempo ya emitido (ver midi_parser) para que el error no se acumule.
+
+    Returns:
+        full (int or np.ndarray): número de time_shifts máximos
+        leftover (int or np.ndarray): k del time_shift_k sobrante, -1 si no hay
     """
-    if lth % div != 0:
-        raise ValueError("lth must be divisible by div")
-
-    time_shifts = []
-    for i in range(time // lth):
-        time_shifts.append(round_(lth / div))
-    leftover_time_shift = round_((time % lth) / div)
-    if leftover_time_shift > 0:
-        time_shifts.append(leftover_time_shift)
-    return time_shifts
-
-def round_(a):
-    """Función de redondeo personalizada"""
-    b = a // 1
-    decimal_digits = a % 1
-    adder = 1 if decimal_digits >= 0.5 else 0
-    return int(b + adder)
+    full = time // LTH
+    leftover = np.searchsorted(TIME_EDGES, time - full * LTH, side="right") - 1
+    return full, leftover
 
 def get_note_event_indices(note, instrument, is_on=True):
     """
@@ -109,15 +155,11 @@ def get_note_event_indices(note, instrument, is_on=True):
         is_on (bool): True para note_on, False para note_off
     
     Returns:
-        int: índice en el vocabulario
+        tuple: índice en el vocabulario del token set_channel del instrumento y de la nota
     """
     if not (0 <= note <= 127):
         raise ValueError(f"note must be between 0 and 127, not {note}")
     if not (0 <= instrument < max_instruments):
         raise ValueError(f"instrument must be between 0 and {max_instruments-1}, not {instrument}")
     
-    base = 1  # Skip pad token
-    if not is_on:
-        base += len(note_on_vocab)
-    
-    return base + (instrument * note_on_events) + note 
\ No newline at end of file
+    return CHANNEL_IDX[instrument], (NOTE_ON_IDX[note] if is_on else NOTE_OFF_IDX[note])